@@ -12,7 +12,9 @@ import os
 REQUIRED_PACKAGES = [
     "python-telegram-bot==20.8",
     "flask==3.1.1",
-    "flask-cors==6.0.1"
+    "flask-cors==6.0.1",
+    "waitress==3.0.2",
+    "orjson==3.10.7"
 ]
 
 def install_package(package):
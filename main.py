@@ -1,13 +1,26 @@
+import atexit
+import contextlib
 import json
 import logging
+import mmap
 import os
+import time
 from datetime import datetime
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.error import RetryAfter
 import asyncio
 import threading
+from collections import OrderedDict, deque
 from flask import Flask, render_template, jsonify
 from flask_cors import CORS
+from waitress import serve
+
+# orjson is optional; fall back to the stdlib encoder when it is missing
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Enable logging
 logging.basicConfig(
@@ -18,13 +31,44 @@ logger = logging.getLogger(__name__)
 # Bot configuration
 BOT_TOKEN = os.getenv("BOT_TOKEN", "your_bot_token_here")
 ADMIN_GROUP_ID = os.getenv("ADMIN_GROUP_ID", "-1002760567924")
+ADMIN_GROUP_ID_INT = int(ADMIN_GROUP_ID)
 
 # File paths for data storage
 USERS_FILE = "users.json"
-HISTORY_FILE = "user_history.json"
+HISTORY_FILE = "user_history.jsonl"
 BROADCAST_FILE = "broadcast.json"
 BANLIST_FILE = "banlist.json"
+MSG_MAPPINGS_FILE = "msg_mappings.json"
+REPLY_MAPPINGS_FILE = "reply_mappings.json"
+# Legacy combined mappings file, split into the two files above on startup
 MAPPINGS_FILE = "message_mappings.json"
+# Legacy whole-file history, converted to HISTORY_FILE on startup
+LEGACY_HISTORY_FILE = "user_history.json"
+
+# Maximum number of message/reply mappings kept; the oldest are evicted first
+MAX_MAPPINGS = 50_000
+
+# History entries kept in memory: across all users, and per user for /history
+RECENT_HISTORY_SIZE = 10_000
+HISTORY_PREVIEW_SIZE = 10
+
+# Maximum number of concurrent Telegram requests during broadcast fan-out
+BROADCAST_CONCURRENCY = 20
+
+# Times a broadcast request is retried after Telegram flood control (RetryAfter)
+BROADCAST_MAX_RETRIES = 5
+
+# HTTP connections shared by all bot requests; must exceed BROADCAST_CONCURRENCY
+BOT_CONNECTION_POOL_SIZE = 64
+
+# Number of past broadcasts kept for /delete all
+MAX_BROADCASTS = 50
+
+# Longest text sent in one Telegram message by the bot
+MAX_MESSAGE_LENGTH = 4000
+
+# Seconds between background flushes of modified stores
+FLUSH_INTERVAL = 0.5
 
 # Arabic messages
 CONFIRMATION_MESSAGE = "✅ تم إرسال رسالتك، سيتم الرد عليك في أقرب وقت ممكن ."
@@ -38,23 +82,257 @@ WELCOME_MESSAGE = """مرحبا بك . في بوت تواصل الأقسام
 ارسل رسالتك و سيتم الرد عليك في أقرب وقت 🫡"""
 BAN_MESSAGE = "لقد تم حظرك من استخدام البوت❌"
 UNBAN_MESSAGE = "! لقد تم رفع الحظر نرجو عدم تكرار الأخطاء السابقة"
+FORWARD_TEMPLATE = (
+    "📩 رسالة جديدة من:\n"
+    "👤 الاسم: {display_name}\n"
+    "🆔 المعرف: @{username}\n"
+    "🔢 الرقم: {id}\n"
+    "📅 التاريخ: {ts}"
+)
+
+def _json_loads(data):
+    """Parse JSON from bytes or a memoryview"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(bytes(data))
+
+def _json_dumps(data, indent=False):
+    """Serialize data to UTF-8 JSON bytes"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(data, option=option)
+    return json.dumps(data, ensure_ascii=False, indent=2 if indent else None).encode('utf-8')
 
 def load_json_file(filename):
     """Load data from JSON file, create empty if doesn't exist"""
     try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return {}
+            # Parse straight from the mapped pages instead of copying via read()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as view:
+                    return _json_loads(view)
     except (FileNotFoundError, json.JSONDecodeError):
         return {}
 
+def _atomic_write(filename, payload):
+    """Write payload bytes to a temp file and swap it into place"""
+    tmp_filename = f"{filename}.tmp"
+    with _WRITE_LOCK:
+        with open(tmp_filename, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+
 def save_json_file(filename, data):
     """Save data to JSON file"""
     try:
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        _atomic_write(filename, _json_dumps(data, indent=True))
     except Exception as e:
         logger.error(f"Error saving to {filename}: {e}")
 
+# In-memory stores: each JSON file is parsed once and then mutated in place.
+# The Flask thread reads the same dicts, so every mutation and every snapshot
+# taken for iteration holds that file's lock.
+_CACHE = {
+    USERS_FILE: None,
+    BROADCAST_FILE: None,
+    BANLIST_FILE: None,
+    MSG_MAPPINGS_FILE: None,
+    REPLY_MAPPINGS_FILE: None
+}
+# Stores keyed by integer ids (JSON object keys are always strings on disk)
+_INT_KEYED = {USERS_FILE, BANLIST_FILE, MSG_MAPPINGS_FILE, REPLY_MAPPINGS_FILE}
+# Stores capped at MAX_MAPPINGS entries, kept in insertion order
+_BOUNDED = {MSG_MAPPINGS_FILE, REPLY_MAPPINGS_FILE}
+_LOCKS = {filename: threading.RLock() for filename in _CACHE}
+_WRITE_LOCK = threading.Lock()
+
+# Stores modified since the last flush, mapped to a change counter so a flush
+# only marks a store clean if nothing changed while it was being written
+_dirty = {}
+
+def _read_store(filename):
+    """Load a store from disk into its in-memory form"""
+    data = load_json_file(filename)
+    if filename in _INT_KEYED:
+        data = {int(k): v for k, v in data.items()}
+    if filename in _BOUNDED:
+        data = OrderedDict(data)
+    return data
+
+def get_store(filename):
+    """Return the live in-memory dict for a store, loading it on first use"""
+    with _LOCKS[filename]:
+        if _CACHE[filename] is None:
+            _CACHE[filename] = _read_store(filename)
+        return _CACHE[filename]
+
+async def aload(filename):
+    """Reload a store from disk in a worker thread, unless it has unsaved changes"""
+    if filename in _dirty:
+        logger.warning(f"Not reloading {filename}: it has unsaved changes")
+        return get_store(filename)
+    data = await asyncio.to_thread(_read_store, filename)
+    with _LOCKS[filename]:
+        # The store may have been modified while the file was being read
+        if filename in _dirty:
+            logger.warning(f"Not reloading {filename}: it has unsaved changes")
+            return _CACHE[filename]
+        _CACHE[filename] = data
+    return data
+
+def snapshot_store(filename):
+    """Return a shallow copy of a store that is safe to iterate from another thread"""
+    with _LOCKS[filename]:
+        return dict(get_store(filename))
+
+def schedule_save(filename):
+    """Mark a store as modified so the next flush writes it to disk"""
+    _dirty[filename] = _dirty.get(filename, 0) + 1
+
+def _serialize_store(filename):
+    """Serialize a store, returning the payload and the change counter it covers"""
+    with _LOCKS[filename]:
+        return _json_dumps(_CACHE[filename], indent=True), _dirty.get(filename)
+
+def _mark_clean(filename, version):
+    """Clear a store's dirty flag unless it changed after being serialized"""
+    if _dirty.get(filename) == version:
+        del _dirty[filename]
+
+async def flusher():
+    """Periodically write modified stores to disk off the event loop"""
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        # A store leaves _dirty only after its write succeeds, so a failed or
+        # cancelled write is retried by the next flush or by flush_all()
+        for filename in list(_dirty):
+            try:
+                payload, version = _serialize_store(filename)
+                await asyncio.to_thread(_atomic_write, filename, payload)
+            except Exception as e:
+                logger.error(f"Error saving to {filename}: {e}")
+                continue
+            _mark_clean(filename, version)
+        if _pending_history:
+            try:
+                await asyncio.to_thread(_flush_history)
+            except Exception as e:
+                logger.error(f"Error appending to {HISTORY_FILE}: {e}")
+
+def flush_all():
+    """Synchronously write every modified store and pending history (used on shutdown)"""
+    for filename in list(_dirty):
+        try:
+            payload, version = _serialize_store(filename)
+            _atomic_write(filename, payload)
+        except Exception as e:
+            logger.error(f"Error saving to {filename}: {e}")
+            continue
+        _mark_clean(filename, version)
+    try:
+        _flush_history()
+    except Exception as e:
+        logger.error(f"Error appending to {HISTORY_FILE}: {e}")
+
+atexit.register(flush_all)
+
+# History is an append-only JSON-lines log; only recent entries stay in memory
+_HISTORY_LOCK = threading.RLock()
+_history_loaded = False
+# Set when the log may end in a partial line, so the next append starts a new one
+_history_needs_newline = False
+# Encoded entries waiting for the flusher to append them to the log
+_pending_history = []
+_HISTORY_WRITE_LOCK = threading.Lock()
+_recent_history = deque(maxlen=RECENT_HISTORY_SIZE)
+_user_history = {}
+_history_counts = {}
+# Running totals for /api/stats, maintained as entries are recorded
+_counters = {'total_messages': 0}
+
+def _record_history(entry):
+    """Add a history entry to the in-memory views"""
+    user_id = entry['user_id']
+    if user_id not in _user_history:
+        _user_history[user_id] = deque(maxlen=HISTORY_PREVIEW_SIZE)
+    _user_history[user_id].append(entry)
+    _history_counts[user_id] = _history_counts.get(user_id, 0) + 1
+    _counters['total_messages'] += 1
+    _recent_history.append(entry)
+
+def load_history():
+    """Read the history log once to build the in-memory views"""
+    global _history_loaded, _history_needs_newline
+    with _HISTORY_LOCK:
+        if _history_loaded:
+            return
+        try:
+            with open(HISTORY_FILE, 'rb') as f:
+                if os.fstat(f.fileno()).st_size:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        for line in iter(mm.readline, b""):
+                            try:
+                                _record_history(_json_loads(line))
+                            except (json.JSONDecodeError, KeyError, TypeError):
+                                continue
+                        # A torn last line must not swallow the next appended entry
+                        if mm[-1:] != b"\n":
+                            logger.warning(f"{HISTORY_FILE} ends in a partial line")
+                            _history_needs_newline = True
+        except FileNotFoundError:
+            pass
+        _history_loaded = True
+
+def _append_history(data):
+    """Append encoded lines to the history log, first ending any partial line"""
+    global _history_needs_newline
+    with open(HISTORY_FILE, 'ab') as f:
+        if _history_needs_newline and f.tell():
+            data = b"\n" + data
+        # Stays set if the write fails part-way, so the retry starts on a fresh line
+        _history_needs_newline = True
+        f.write(data)
+    _history_needs_newline = False
+
+def _flush_history():
+    """Append buffered history lines to the log, keeping them buffered on failure"""
+    with _HISTORY_WRITE_LOCK:
+        with _HISTORY_LOCK:
+            lines = _pending_history[:]
+        if not lines:
+            return
+        _append_history(b"".join(lines))
+        with _HISTORY_LOCK:
+            del _pending_history[:len(lines)]
+
+def preload_all_stores():
+    """Load every store and the history log before the bot starts handling updates"""
+    for filename in _CACHE:
+        get_store(filename)
+    load_history()
+
+def get_user_history(user_id):
+    """Return a user's most recent history entries and their total count"""
+    load_history()
+    with _HISTORY_LOCK:
+        return list(_user_history.get(user_id, ())), _history_counts.get(user_id, 0)
+
+# [second, formatted timestamp] of the last now_iso() call
+_ts_cache = [None, ""]
+
+def now_iso():
+    """Current local time as an ISO string, formatted at most once per second"""
+    second = int(time.time())
+    if second != _ts_cache[0]:
+        _ts_cache[:] = [second, datetime.fromtimestamp(second).isoformat()]
+    return _ts_cache[1]
+
 def get_user_info(user):
     """Extract user information"""
     return {
@@ -66,90 +344,234 @@ def get_user_info(user):
     }
 
 def add_user(user_id, user_info):
-    """Add user to users database"""
-    users = load_json_file(USERS_FILE)
-    users[str(user_id)] = {
-        **user_info,
-        'join_date': datetime.now().isoformat()
-    }
-    save_json_file(USERS_FILE, users)
+    """Add or update a user, keeping their original join date"""
+    users = get_store(USERS_FILE)
+    with _LOCKS[USERS_FILE]:
+        current = users.get(user_id)
+        if current and all(current.get(k) == v for k, v in user_info.items()):
+            return
+        users[user_id] = {
+            **user_info,
+            'join_date': current['join_date'] if current and 'join_date' in current else now_iso()
+        }
+    schedule_save(USERS_FILE)
 
 def add_to_history(user_id, message_text, message_type="user_message"):
     """Add message to user history"""
-    history = load_json_file(HISTORY_FILE)
-    user_id_str = str(user_id)
-    
-    if user_id_str not in history:
-        history[user_id_str] = []
-    
-    history[user_id_str].append({
+    entry = {
+        'user_id': int(user_id),
         'message': message_text,
         'type': message_type,
-        'timestamp': datetime.now().isoformat()
-    })
-    
-    save_json_file(HISTORY_FILE, history)
+        'timestamp': now_iso()
+    }
+    load_history()
+    # The flusher appends the line off the event loop and retries it until written
+    with _HISTORY_LOCK:
+        _record_history(entry)
+        _pending_history.append(_json_dumps(entry) + b"\n")
 
 def is_user_banned(user_id):
     """Check if user is banned"""
-    banlist = load_json_file(BANLIST_FILE)
-    return str(user_id) in banlist
+    return user_id in get_store(BANLIST_FILE)
 
 def ban_user(user_id, reason="No reason provided"):
     """Ban a user"""
-    banlist = load_json_file(BANLIST_FILE)
-    users = load_json_file(USERS_FILE)
-    
-    user_info = users.get(str(user_id), {})
-    banlist[str(user_id)] = {
-        'username': user_info.get('username', 'Unknown'),
-        'display_name': user_info.get('display_name', 'Unknown'),
-        'reason': reason,
-        'ban_date': datetime.now().isoformat()
-    }
-    
-    save_json_file(BANLIST_FILE, banlist)
+    user_info = get_store(USERS_FILE).get(user_id, {})
+    banlist = get_store(BANLIST_FILE)
+    with _LOCKS[BANLIST_FILE]:
+        banlist[user_id] = {
+            'username': user_info.get('username', 'Unknown'),
+            'display_name': user_info.get('display_name', 'Unknown'),
+            'reason': reason,
+            'ban_date': now_iso()
+        }
+    schedule_save(BANLIST_FILE)
 
 def unban_user(user_id):
     """Unban a user"""
-    banlist = load_json_file(BANLIST_FILE)
-    if str(user_id) in banlist:
-        del banlist[str(user_id)]
-        save_json_file(BANLIST_FILE, banlist)
-        return True
-    return False
+    banlist = get_store(BANLIST_FILE)
+    with _LOCKS[BANLIST_FILE]:
+        removed = banlist.pop(user_id, None) is not None
+    if removed:
+        schedule_save(BANLIST_FILE)
+    return removed
+
+def _bounded_set(filename, key, value):
+    """Insert into a bounded store, evicting the oldest entries over MAX_MAPPINGS"""
+    store = get_store(filename)
+    with _LOCKS[filename]:
+        store[key] = value
+        store.move_to_end(key)
+        while len(store) > MAX_MAPPINGS:
+            store.popitem(last=False)
+    schedule_save(filename)
 
 def save_message_mapping(forwarded_msg_id, user_id):
     """Save message mapping for replies"""
-    mappings = load_json_file(MAPPINGS_FILE)
-    mappings[f"msg_{forwarded_msg_id}"] = user_id
-    save_json_file(MAPPINGS_FILE, mappings)
+    _bounded_set(MSG_MAPPINGS_FILE, int(forwarded_msg_id), user_id)
 
 def get_user_from_mapping(forwarded_msg_id):
     """Get original user ID from forwarded message ID"""
-    mappings = load_json_file(MAPPINGS_FILE)
-    return mappings.get(f"msg_{forwarded_msg_id}")
+    return get_store(MSG_MAPPINGS_FILE).get(int(forwarded_msg_id))
 
 def save_reply_mapping(admin_msg_id, user_id, reply_msg_id):
     """Save reply mapping for potential deletion"""
-    mappings = load_json_file(MAPPINGS_FILE)
-    mappings[f"reply_{admin_msg_id}"] = {
+    _bounded_set(REPLY_MAPPINGS_FILE, int(admin_msg_id), {
         'user_id': user_id,
         'message_id': reply_msg_id
-    }
-    save_json_file(MAPPINGS_FILE, mappings)
+    })
 
 def get_reply_mapping(admin_msg_id):
     """Get reply mapping info"""
-    mappings = load_json_file(MAPPINGS_FILE)
-    return mappings.get(f"reply_{admin_msg_id}")
+    return get_store(REPLY_MAPPINGS_FILE).get(int(admin_msg_id))
 
 def remove_reply_mapping(admin_msg_id):
     """Remove reply mapping"""
-    mappings = load_json_file(MAPPINGS_FILE)
-    if f"reply_{admin_msg_id}" in mappings:
-        del mappings[f"reply_{admin_msg_id}"]
-        save_json_file(MAPPINGS_FILE, mappings)
+    reply_mappings = get_store(REPLY_MAPPINGS_FILE)
+    with _LOCKS[REPLY_MAPPINGS_FILE]:
+        removed = reply_mappings.pop(int(admin_msg_id), None) is not None
+    if removed:
+        schedule_save(REPLY_MAPPINGS_FILE)
+
+def migrate_legacy_mappings():
+    """Split the old combined mappings file into message and reply stores"""
+    if not os.path.exists(MAPPINGS_FILE):
+        return
+    
+    legacy = load_json_file(MAPPINGS_FILE)
+    targets = {'msg': MSG_MAPPINGS_FILE, 'reply': REPLY_MAPPINGS_FILE}
+    for key, value in legacy.items():
+        prefix, _, msg_id = key.partition('_')
+        filename = targets.get(prefix)
+        try:
+            msg_id = int(msg_id)
+        except ValueError:
+            filename = None
+        if filename is None:
+            logger.warning(f"Skipping malformed mapping key in {MAPPINGS_FILE}: {key!r}")
+            continue
+        if msg_id not in get_store(filename):
+            _bounded_set(filename, msg_id, value)
+    
+    # Write both stores before deleting the legacy file, so a failed write
+    # leaves it in place for the next start
+    try:
+        for filename in (MSG_MAPPINGS_FILE, REPLY_MAPPINGS_FILE):
+            _atomic_write(filename, _json_dumps(get_store(filename), indent=True))
+    except Exception as e:
+        logger.error(f"Error migrating {MAPPINGS_FILE}: {e}")
+        return
+    os.remove(MAPPINGS_FILE)
+    logger.info(f"Migrated {len(legacy)} entries from {MAPPINGS_FILE}")
+
+def migrate_legacy_history():
+    """Convert the old per-user history file into the append-only log"""
+    if not os.path.exists(LEGACY_HISTORY_FILE):
+        return
+    
+    legacy = load_json_file(LEGACY_HISTORY_FILE)
+    entries = [
+        {'user_id': int(user_id), **entry}
+        for user_id, messages in legacy.items()
+        for entry in messages
+        if isinstance(entry, dict) and 'message' in entry and 'timestamp' in entry
+    ]
+    entries.sort(key=lambda x: x['timestamp'])
+    
+    # Legacy entries predate the log, so they go first. Entries already in
+    # the log (from an interrupted earlier run) are skipped, so re-running
+    # the migration never duplicates history.
+    try:
+        with open(HISTORY_FILE, 'rb') as f:
+            existing = f.read()
+    except FileNotFoundError:
+        existing = b""
+    if existing and not existing.endswith(b"\n"):
+        existing += b"\n"
+    seen = set()
+    for line in existing.splitlines():
+        try:
+            entry = _json_loads(line)
+            seen.add((entry['user_id'], entry['timestamp'], entry['message'], entry.get('type')))
+        except (json.JSONDecodeError, KeyError, TypeError):
+            continue
+    lines = [
+        _json_dumps(entry) + b"\n"
+        for entry in entries
+        if (entry['user_id'], entry['timestamp'], entry['message'], entry.get('type')) not in seen
+    ]
+    
+    # Write the combined log to a temp file and swap it in before deleting
+    # the legacy file
+    try:
+        _atomic_write(HISTORY_FILE, b"".join(lines) + existing)
+    except Exception as e:
+        logger.error(f"Error migrating {LEGACY_HISTORY_FILE}: {e}")
+        return
+    os.remove(LEGACY_HISTORY_FILE)
+    logger.info(f"Migrated {len(lines)} history entries from {LEGACY_HISTORY_FILE}")
+
+# (attribute, formatter) pairs used to describe a message for history, ordered
+# by how often each type arrives. document stays ahead of animation because
+# Telegram also sets document on GIF messages.
+_MEDIA_FORMATTERS = (
+    ('text', lambda m: m.text),
+    ('photo', lambda m: f"[صورة] {m.caption or ''}"),
+    ('voice', lambda m: "[رسالة صوتية]"),
+    ('document', lambda m: f"[ملف: {m.document.file_name}] {m.caption or ''}"),
+    ('video', lambda m: f"[فيديو] {m.caption or ''}"),
+    ('sticker', lambda m: f"[ملصق: {m.sticker.emoji or ''}]"),
+    ('audio', lambda m: f"[صوت] {m.caption or ''}"),
+    ('animation', lambda m: f"[GIF] {m.caption or ''}"),
+    ('video_note', lambda m: "[فيديو دائري]"),
+    ('location', lambda m: f"[موقع: {m.location.latitude}, {m.location.longitude}]"),
+    ('contact', lambda m: f"[جهة اتصال: {m.contact.first_name}]"),
+)
+
+def describe_message(message):
+    """Describe a message's content for history"""
+    return next(
+        (formatter(message) for attr, formatter in _MEDIA_FORMATTERS if getattr(message, attr)),
+        "[نوع رسالة غير مدعوم]"
+    )
+
+async def call_with_retry(method, **kwargs):
+    """Call a bot method, waiting out Telegram flood control before retrying"""
+    attempt = 0
+    while True:
+        try:
+            return await method(**kwargs)
+        except RetryAfter as e:
+            attempt += 1
+            if attempt > BROADCAST_MAX_RETRIES:
+                raise
+            logger.warning(f"Flood control hit, retrying in {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+
+def iter_message_chunks(parts, limit=MAX_MESSAGE_LENGTH):
+    """Join text parts into chunks of at most limit characters"""
+    chunk = []
+    size = 0
+    for part in parts:
+        if chunk and size + len(part) > limit:
+            yield "".join(chunk)
+            chunk, size = [], 0
+        while len(part) > limit:
+            yield part[:limit]
+            part = part[limit:]
+        chunk.append(part)
+        size += len(part)
+    if chunk:
+        yield "".join(chunk)
+
+# Id of the most recent broadcast, or None until one is sent this run
+_latest_broadcast = None
+
+# Serializes the header + forward pair sent to the admin group per user message
+_forward_lock = asyncio.Lock()
+
+# Per-user locks that keep admin replies to the same user in order
+_reply_locks = {}
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command"""
@@ -187,56 +609,29 @@ async def handle_private_message(update: Update, context: ContextTypes.DEFAULT_T
     user_info = get_user_info(user)
     add_user(user.id, user_info)
     
-    # Determine message type and content for history
-    message_content = ""
-    if message.text:
-        message_content = message.text
-    elif message.photo:
-        message_content = f"[صورة] {message.caption or ''}"
-    elif message.video:
-        message_content = f"[فيديو] {message.caption or ''}"
-    elif message.audio:
-        message_content = f"[صوت] {message.caption or ''}"
-    elif message.voice:
-        message_content = "[رسالة صوتية]"
-    elif message.document:
-        message_content = f"[ملف: {message.document.file_name}] {message.caption or ''}"
-    elif message.sticker:
-        message_content = f"[ملصق: {message.sticker.emoji or ''}]"
-    elif message.animation:
-        message_content = f"[GIF] {message.caption or ''}"
-    elif message.video_note:
-        message_content = "[فيديو دائري]"
-    elif message.location:
-        message_content = f"[موقع: {message.location.latitude}, {message.location.longitude}]"
-    elif message.contact:
-        message_content = f"[جهة اتصال: {message.contact.first_name}]"
-    else:
-        message_content = "[نوع رسالة غير مدعوم]"
+    message_content = describe_message(message)
     
     add_to_history(user.id, message_content)
     
     # Forward message to admin group
     try:
         # Send user info first
-        forward_text = f"📩 رسالة جديدة من:\n"
-        forward_text += f"👤 الاسم: {user_info['display_name']}\n"
-        forward_text += f"🆔 المعرف: @{user_info['username']}\n"
-        forward_text += f"🔢 الرقم: {user.id}\n"
-        forward_text += f"📅 التاريخ: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+        forward_text = FORWARD_TEMPLATE.format_map({**user_info, 'ts': now_iso().replace('T', ' ')})
         
         logger.info(f"Attempting to send message to admin group: {ADMIN_GROUP_ID}")
-        await context.bot.send_message(
-            chat_id=ADMIN_GROUP_ID,
-            text=forward_text
-        )
-        
-        # Forward the actual message (preserves media)
-        forwarded_message = await message.forward(chat_id=ADMIN_GROUP_ID)
+        # Updates run concurrently, so keep each header directly above its message
+        async with _forward_lock:
+            await context.bot.send_message(
+                chat_id=ADMIN_GROUP_ID,
+                text=forward_text
+            )
+            
+            # Forward the actual message (preserves media)
+            forwarded_message = await message.forward(chat_id=ADMIN_GROUP_ID)
         
         # Store mapping for replies (use forwarded message ID) - now persistent
         save_message_mapping(forwarded_message.message_id, user.id)
-        logger.info(f"Message forwarded successfully, stored mapping: msg_{forwarded_message.message_id} -> {user.id}")
+        logger.info(f"Message forwarded successfully, stored mapping: {forwarded_message.message_id} -> {user.id}")
         
     except Exception as e:
         logger.error(f"Error forwarding message to admin group {ADMIN_GROUP_ID}: {e}")
@@ -251,7 +646,7 @@ async def handle_group_message(update: Update, context: ContextTypes.DEFAULT_TYP
     chat = update.effective_chat
     
     # Only work in admin group
-    if str(chat.id) != str(ADMIN_GROUP_ID):
+    if chat.id != ADMIN_GROUP_ID_INT:
         return
     
     # Handle replies to forwarded messages
@@ -269,45 +664,25 @@ async def handle_group_message(update: Update, context: ContextTypes.DEFAULT_TYP
         if original_user_id:
             
             try:
-                # Determine if admin is replying with text or media
-                if message.text:
-                    # Text reply
-                    sent_reply = await context.bot.send_message(
-                        chat_id=original_user_id,
-                        text=f"📩 رد من الإدارة:\n\n{message.text}"
-                    )
-                    reply_content = f"Admin reply: {message.text}"
-                else:
-                    # Media reply - send admin info first then forward the media
-                    await context.bot.send_message(
-                        chat_id=original_user_id,
-                        text="📩 رد من الإدارة:"
-                    )
-                    sent_reply = await message.forward(chat_id=original_user_id)
-                    
-                    # Determine reply content for history
-                    if message.photo:
-                        reply_content = f"Admin reply: [صورة] {message.caption or ''}"
-                    elif message.video:
-                        reply_content = f"Admin reply: [فيديو] {message.caption or ''}"
-                    elif message.audio:
-                        reply_content = f"Admin reply: [صوت] {message.caption or ''}"
-                    elif message.voice:
-                        reply_content = "Admin reply: [رسالة صوتية]"
-                    elif message.document:
-                        reply_content = f"Admin reply: [ملف: {message.document.file_name}] {message.caption or ''}"
-                    elif message.sticker:
-                        reply_content = f"Admin reply: [ملصق: {message.sticker.emoji or ''}]"
-                    elif message.animation:
-                        reply_content = f"Admin reply: [GIF] {message.caption or ''}"
-                    elif message.video_note:
-                        reply_content = "Admin reply: [فيديو دائري]"
-                    elif message.location:
-                        reply_content = f"Admin reply: [موقع: {message.location.latitude}, {message.location.longitude}]"
-                    elif message.contact:
-                        reply_content = f"Admin reply: [جهة اتصال: {message.contact.first_name}]"
+                # Updates run concurrently, so replies to one user are sent one at a time
+                async with _reply_locks.setdefault(original_user_id, asyncio.Lock()):
+                    # Determine if admin is replying with text or media
+                    if message.text:
+                        # Text reply
+                        sent_reply = await context.bot.send_message(
+                            chat_id=original_user_id,
+                            text=f"📩 رد من الإدارة:\n\n{message.text}"
+                        )
+                        reply_content = f"Admin reply: {message.text}"
                     else:
-                        reply_content = "Admin reply: [نوع رسالة غير مدعوم]"
+                        # Media reply - send admin info first then forward the media
+                        await context.bot.send_message(
+                            chat_id=original_user_id,
+                            text="📩 رد من الإدارة:"
+                        )
+                        sent_reply = await message.forward(chat_id=original_user_id)
+                        
+                        reply_content = f"Admin reply: {describe_message(message)}"
                 
                 # Store reply message ID for potential deletion - now persistent
                 save_reply_mapping(message.message_id, original_user_id, sent_reply.message_id)
@@ -320,12 +695,15 @@ async def handle_group_message(update: Update, context: ContextTypes.DEFAULT_TYP
                 
             except Exception as e:
                 await message.reply_text(f"❌ فشل في إرسال الرد: {str(e)}")
+        else:
+            logger.info(f"No mapping for message {replied_msg_id}, it may have been evicted")
 
 async def cmd_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send message to all users"""
+    global _latest_broadcast
     chat = update.effective_chat
     
-    if str(chat.id) != str(ADMIN_GROUP_ID):
+    if chat.id != ADMIN_GROUP_ID_INT:
         return
     
     if not context.args:
@@ -333,30 +711,37 @@ async def cmd_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     broadcast_message = " ".join(context.args)
-    users = load_json_file(USERS_FILE)
-    broadcast_data = load_json_file(BROADCAST_FILE)
+    users = list(get_store(USERS_FILE))
+    broadcast_data = get_store(BROADCAST_FILE)
     
-    success_count = 0
-    failed_count = 0
     broadcast_id = datetime.now().isoformat()
-    broadcast_data[broadcast_id] = {'recipients': []}
+    text = f"📢 رسالة من الإدارة:\n\n{broadcast_message}"
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    send = context.bot.send_message
     
-    for user_id in users.keys():
-        try:
-            sent_msg = await context.bot.send_message(
-                chat_id=int(user_id),
-                text=f"📢 رسالة من الإدارة:\n\n{broadcast_message}"
-            )
-            broadcast_data[broadcast_id]['recipients'].append({
-                'user_id': user_id,
-                'message_id': sent_msg.message_id
-            })
-            success_count += 1
-        except Exception as e:
-            failed_count += 1
-            logger.error(f"Failed to send to {user_id}: {e}")
-    
-    save_json_file(BROADCAST_FILE, broadcast_data)
+    async def send_one(user_id):
+        async with semaphore:
+            try:
+                return await call_with_retry(send, chat_id=user_id, text=text)
+            except Exception as e:
+                logger.error(f"Failed to send to {user_id}: {e}")
+                return None
+    
+    results = await asyncio.gather(*(send_one(user_id) for user_id in users))
+    
+    recipients = [
+        {'user_id': user_id, 'message_id': sent_msg.message_id}
+        for user_id, sent_msg in zip(users, results)
+        if sent_msg is not None
+    ]
+    success_count = len(recipients)
+    failed_count = len(users) - success_count
+    with _LOCKS[BROADCAST_FILE]:
+        broadcast_data[broadcast_id] = {'recipients': recipients}
+        while len(broadcast_data) > MAX_BROADCASTS:
+            del broadcast_data[next(iter(broadcast_data))]
+    _latest_broadcast = broadcast_id
+    schedule_save(BROADCAST_FILE)
     
     await update.message.reply_text(
         f"✅ تم إرسال الرسالة\n"
@@ -368,11 +753,10 @@ async def cmd_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show user count"""
     chat = update.effective_chat
     
-    if str(chat.id) != str(ADMIN_GROUP_ID):
+    if chat.id != ADMIN_GROUP_ID_INT:
         return
     
-    users = load_json_file(USERS_FILE)
-    actual_user_count = len(users)
+    actual_user_count = len(get_store(USERS_FILE))
     displayed_count = 1200 + actual_user_count
     
     await update.message.reply_text(f"👥 عدد المستخدمين: {displayed_count}")
@@ -381,7 +765,7 @@ async def cmd_ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Ban a user"""
     chat = update.effective_chat
     
-    if str(chat.id) != str(ADMIN_GROUP_ID):
+    if chat.id != ADMIN_GROUP_ID_INT:
         return
     
     if not context.args:
@@ -402,7 +786,7 @@ async def cmd_unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Unban a user"""
     chat = update.effective_chat
     
-    if str(chat.id) != str(ADMIN_GROUP_ID):
+    if chat.id != ADMIN_GROUP_ID_INT:
         return
     
     if not context.args:
@@ -430,35 +814,33 @@ async def cmd_banlist(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show banned users"""
     chat = update.effective_chat
     
-    if str(chat.id) != str(ADMIN_GROUP_ID):
+    if chat.id != ADMIN_GROUP_ID_INT:
         return
     
-    banlist = load_json_file(BANLIST_FILE)
+    banlist = snapshot_store(BANLIST_FILE)
     
     if not banlist:
         await update.message.reply_text("📋 لا يوجد مستخدمين محظورين")
         return
     
-    message = "🚫 قائمة المحظورين:\n\n"
+    parts = ["🚫 قائمة المحظورين:\n\n"]
     for user_id, data in banlist.items():
-        message += f"👤 {data['display_name']} (@{data['username']})\n"
-        message += f"🆔 {user_id}\n"
-        message += f"📝 السبب: {data['reason']}\n"
-        message += f"📅 تاريخ الحظر: {data['ban_date'][:10]}\n\n"
+        parts.append(
+            f"👤 {data['display_name']} (@{data['username']})\n"
+            f"🆔 {user_id}\n"
+            f"📝 السبب: {data['reason']}\n"
+            f"📅 تاريخ الحظر: {data['ban_date'][:10]}\n\n"
+        )
     
     # Split long messages
-    if len(message) > 4000:
-        parts = [message[i:i+4000] for i in range(0, len(message), 4000)]
-        for part in parts:
-            await update.message.reply_text(part)
-    else:
-        await update.message.reply_text(message)
+    for chunk in iter_message_chunks(parts):
+        await update.message.reply_text(chunk)
 
 async def cmd_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show user message history"""
     chat = update.effective_chat
     
-    if str(chat.id) != str(ADMIN_GROUP_ID):
+    if chat.id != ADMIN_GROUP_ID_INT:
         return
     
     user_id = None
@@ -480,64 +862,76 @@ async def cmd_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ الاستخدام: /history <المعرف> أو رد على رسالة")
         return
     
-    history = load_json_file(HISTORY_FILE)
-    user_history = history.get(str(user_id), [])
+    user_history, total_messages = get_user_history(user_id)
     
     if not user_history:
         await update.message.reply_text("📋 لا يوجد تاريخ رسائل لهذا المستخدم")
         return
     
-    users = load_json_file(USERS_FILE)
-    user_info = users.get(str(user_id), {})
+    user_info = get_store(USERS_FILE).get(user_id, {})
     
-    message = f"📋 تاريخ رسائل {user_info.get('display_name', 'Unknown')} ({user_id}):\n\n"
+    parts = [f"📋 تاريخ رسائل {user_info.get('display_name', 'Unknown')} ({user_id}):\n\n"]
     
-    for entry in user_history[-10:]:  # Show last 10 messages
+    for entry in user_history:  # Last HISTORY_PREVIEW_SIZE messages
         timestamp = entry['timestamp'][:19].replace('T', ' ')
-        message += f"📅 {timestamp}\n"
-        message += f"📝 {entry['message'][:100]}{'...' if len(entry['message']) > 100 else ''}\n"
-        message += f"🏷️ {entry['type']}\n\n"
+        parts.append(
+            f"📅 {timestamp}\n"
+            f"📝 {entry['message'][:100]}{'...' if len(entry['message']) > 100 else ''}\n"
+            f"🏷️ {entry['type']}\n\n"
+        )
     
-    if len(user_history) > 10:
-        message += f"... و {len(user_history) - 10} رسالة أخرى"
+    if total_messages > len(user_history):
+        parts.append(f"... و {total_messages - len(user_history)} رسالة أخرى")
     
-    await update.message.reply_text(message)
+    for chunk in iter_message_chunks(parts):
+        await update.message.reply_text(chunk)
 
 async def cmd_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Delete messages"""
+    global _latest_broadcast
     chat = update.effective_chat
     
-    if str(chat.id) != str(ADMIN_GROUP_ID):
+    if chat.id != ADMIN_GROUP_ID_INT:
         return
     
     # Handle /delete all
     if context.args and context.args[0].lower() == "all":
-        broadcast_data = load_json_file(BROADCAST_FILE)
+        broadcast_data = get_store(BROADCAST_FILE)
         
         if not broadcast_data:
             await update.message.reply_text("❌ لا يوجد رسائل بث للحذف")
             return
         
-        # Get the latest broadcast
-        latest_broadcast = max(broadcast_data.keys())
+        # Get the latest broadcast (scan the ids only on a cold start)
+        latest_broadcast = _latest_broadcast
+        if latest_broadcast not in broadcast_data:
+            latest_broadcast = max(broadcast_data)
+        _latest_broadcast = None
         recipients = broadcast_data[latest_broadcast]['recipients']
         
-        deleted_count = 0
-        failed_count = 0
-        for recipient in recipients:
-            try:
-                await context.bot.delete_message(
-                    chat_id=int(recipient['user_id']),
-                    message_id=recipient['message_id']
-                )
-                deleted_count += 1
-            except Exception as e:
-                failed_count += 1
-                logger.error(f"Failed to delete broadcast message for {recipient['user_id']}: {e}")
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        
+        async def delete_one(recipient):
+            async with semaphore:
+                try:
+                    await call_with_retry(
+                        context.bot.delete_message,
+                        chat_id=int(recipient['user_id']),
+                        message_id=recipient['message_id']
+                    )
+                    return True
+                except Exception as e:
+                    logger.error(f"Failed to delete broadcast message for {recipient['user_id']}: {e}")
+                    return False
+        
+        results = await asyncio.gather(*(delete_one(recipient) for recipient in recipients))
+        deleted_count = sum(results)
+        failed_count = len(results) - deleted_count
         
         # Remove the broadcast record
-        del broadcast_data[latest_broadcast]
-        save_json_file(BROADCAST_FILE, broadcast_data)
+        with _LOCKS[BROADCAST_FILE]:
+            broadcast_data.pop(latest_broadcast, None)
+        schedule_save(BROADCAST_FILE)
         
         await update.message.reply_text(f"✅ تم حذف آخر رسالة بث\nنجح: {deleted_count}\nفشل: {failed_count}")
         return
@@ -548,7 +942,6 @@ async def cmd_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     replied_msg_id = update.message.reply_to_message.message_id
-    user_id_key = f"msg_{replied_msg_id}"
     
     try:
         # Delete the message in admin group
@@ -577,7 +970,7 @@ async def cmd_commands(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show all available commands"""
     chat = update.effective_chat
     
-    if str(chat.id) != str(ADMIN_GROUP_ID):
+    if chat.id != ADMIN_GROUP_ID_INT:
         return
     
     commands_text = """📋 قائمة الأوامر المتاحة:
@@ -609,26 +1002,18 @@ def dashboard():
 def get_stats():
     """Get bot statistics"""
     try:
-        users = load_json_file(USERS_FILE)
-        history = load_json_file(HISTORY_FILE)
-        banlist = load_json_file(BANLIST_FILE)
-        mappings = load_json_file(MAPPINGS_FILE)
+        users = get_store(USERS_FILE)
+        banlist = get_store(BANLIST_FILE)
         
-        # Calculate message count
-        total_messages = 0
-        for user_messages in history.values():
-            total_messages += len(user_messages)
-        
-        # Get active mappings count
-        active_mappings = len([k for k in mappings.keys() if k.startswith('msg_')])
+        load_history()
         
         stats = {
             'total_users': len(users),
             'display_users': 1200 + len(users),  # User preference from replit.md
             'banned_users': len(banlist),
-            'total_messages': total_messages,
-            'active_mappings': active_mappings,
-            'last_updated': datetime.now().isoformat()
+            'total_messages': _counters['total_messages'],
+            'active_mappings': len(get_store(MSG_MAPPINGS_FILE)),
+            'last_updated': now_iso()
         }
         
         return jsonify(stats)
@@ -639,8 +1024,8 @@ def get_stats():
 def get_users():
     """Get user list"""
     try:
-        users = load_json_file(USERS_FILE)
-        banlist = load_json_file(BANLIST_FILE)
+        users = snapshot_store(USERS_FILE)
+        banlist = get_store(BANLIST_FILE)
         
         user_list = []
         for user_id, user_data in users.items():
@@ -664,26 +1049,28 @@ def get_users():
 def get_recent_activity():
     """Get recent bot activity"""
     try:
-        history = load_json_file(HISTORY_FILE)
+        load_history()
+        with _HISTORY_LOCK:
+            history = list(_recent_history)
         
-        # Get recent messages from all users
+        # Walk back from the newest entries, at most 5 per user
         recent_messages = []
-        for user_id, messages in history.items():
-            if not messages:  # Skip empty message lists
+        per_user = {}
+        for message in reversed(history):
+            user_id = message['user_id']
+            if per_user.get(user_id, 0) >= 5:
                 continue
-            for message in messages[-5:]:  # Last 5 messages per user
-                if isinstance(message, dict) and 'message' in message and 'timestamp' in message:
-                    recent_messages.append({
-                        'user_id': user_id,
-                        'message': message['message'][:100] + ('...' if len(message['message']) > 100 else ''),
-                        'type': message.get('type', 'user_message'),
-                        'timestamp': message['timestamp']
-                    })
-        
-        # Sort by timestamp (newest first)
-        recent_messages.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
+            per_user[user_id] = per_user.get(user_id, 0) + 1
+            recent_messages.append({
+                'user_id': user_id,
+                'message': message['message'][:100] + ('...' if len(message['message']) > 100 else ''),
+                'type': message.get('type', 'user_message'),
+                'timestamp': message['timestamp']
+            })
+            if len(recent_messages) >= 20:
+                break
         
-        return jsonify(recent_messages[:20])  # Return 20 most recent
+        return jsonify(recent_messages)
     except Exception as e:
         logger.error(f"Error in recent-activity API: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -691,18 +1078,19 @@ def get_recent_activity():
 @app.route('/health')
 def health_check():
     """Health check endpoint"""
-    return jsonify({'status': 'healthy', 'timestamp': datetime.now().isoformat()})
+    return jsonify({'status': 'healthy', 'timestamp': now_iso()})
 
 def run_flask_app():
-    """Run Flask app in a separate thread"""
-    app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False)
+    """Run Flask app under waitress in a separate thread"""
+    serve(app, host='0.0.0.0', port=5000, threads=8)
 
 def check_dependencies():
     """Check and install required dependencies"""
     required_packages = {
         'telegram': 'python-telegram-bot',
         'flask': 'flask',
-        'flask_cors': 'flask-cors'
+        'flask_cors': 'flask-cors',
+        'waitress': 'waitress'
     }
     
     missing_packages = []
@@ -718,6 +1106,19 @@ def check_dependencies():
         return False
     return True
 
+async def post_init(application):
+    """Start background tasks once the bot's event loop is running"""
+    application.bot_data['flusher_task'] = asyncio.create_task(flusher())
+
+async def post_shutdown(application):
+    """Stop the flusher and write pending changes before the bot exits"""
+    flusher_task = application.bot_data.pop('flusher_task', None)
+    if flusher_task:
+        flusher_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await flusher_task
+    flush_all()
+
 def main():
     """Start the bot"""
     # Check dependencies first
@@ -725,8 +1126,22 @@ def main():
         print("❌ Please install missing dependencies before running the bot")
         return
     
-    # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+    migrate_legacy_mappings()
+    migrate_legacy_history()
+    preload_all_stores()
+    
+    # Create application (a larger HTTP pool lets broadcast fan-out and
+    # concurrent updates overlap)
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .connection_pool_size(BOT_CONNECTION_POOL_SIZE)
+        .pool_timeout(30)
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Add handlers
     application.add_handler(CommandHandler("start", start))